@@ -24,6 +24,17 @@ export const rleFrString = (input) => {
     return result;
 };
 
+/**
+ * Inflate base64 encoded zlib data to string
+ * @param {string} input
+ * @returns {Promise<string>}
+ */
+export const inflateFromBase64 = (input) => {
+    const bytes = Uint8Array.from(atob(input), (c) => c.charCodeAt(0));
+    const stream = new Blob([bytes]).stream().pipeThrough(new DecompressionStream("deflate"));
+    return new Response(stream).text();
+};
+
 /**
  * Parse RLE to mask array
  * @param rows
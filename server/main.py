@@ -1,20 +1,26 @@
+import hashlib
 import os
-import shutil
 import time
+from collections import OrderedDict
 
+import torch
 from PIL import Image
 import numpy as np
 import io
 import base64
+import zlib
 from segment_anything import SamPredictor, SamAutomaticMaskGenerator, sam_model_registry
 from pycocotools import mask as mask_utils
 import lzstring
 
 from fastapi import FastAPI, UploadFile, File
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
 
+lzs = lzstring.LZString()
+
 # 初始化模型
 def init():
     # your model path
@@ -31,6 +37,9 @@ def init():
 
 predictor, mask_generator = init()
 
+# 图像编码器使用半精度推理，Ampere(sm_80)及以上显卡原生支持bf16，更早的显卡使用fp16
+AMP_DTYPE = torch.bfloat16 if torch.cuda.get_device_capability()[0] >= 8 else torch.float16
+
 app = FastAPI()
 
 app.mount("/upload", StaticFiles(directory="upload"), name="upload")
@@ -43,16 +52,58 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-last_image = ""
+# 以下状态与predictor都是进程内全局变量，连续点击的细化依赖它们，
+# 因此uvicorn只能以单worker运行（多worker时请求会落到不同进程）
+last_image_key = None
 last_logit = None
 
+# 缓存最近使用图片的embedding，切换回这些图片时无需重新运行图像编码器
+# 以文件内容的sha256为key，同一张图片以不同文件名上传也能命中
+EMBEDDING_CACHE_SIZE = 8
+embedding_cache = OrderedDict()
+# 文件路径 -> ((mtime_ns, size), sha256)
+file_digests = {}
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def embedding_cache_key(path):
+    path = os.path.abspath(path)
+    signature = file_signature(path)
+    entry = file_digests.get(path)
+    if entry is None or entry[0] != signature:
+        # 不是通过/upload写入的文件（或已在外部被修改），读取内容重新计算hash
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                hasher.update(chunk)
+        entry = (signature, hasher.hexdigest())
+        file_digests[path] = entry
+    return entry[1]
+
+
+def save_upload_file(source, file_path):
+    # 写文件的同时计算内容hash，上传后首次分割无需再读一遍文件
+    hasher = hashlib.sha256()
+    with open(file_path, "wb") as buffer:
+        for chunk in iter(lambda: source.read(1 << 20), b""):
+            hasher.update(chunk)
+            buffer.write(chunk)
+    # 上传总会覆盖记录，即使同大小的文件在同一个mtime刻度内被覆盖也不会用到旧hash
+    path = os.path.abspath(file_path)
+    file_digests[path] = (file_signature(path), hasher.hexdigest())
+
+
 # 上传文件接口
 @app.post("/upload")
 async def upload_file(file: UploadFile = File(...)):
     print("上传图片", file.filename)
     file_path = os.path.join("upload", file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    # 写文件放到线程池中，避免大文件上传时阻塞事件循环
+    await run_in_threadpool(save_upload_file, file.file, file_path)
     # 构造返回的图片 URL
     return JSONResponse(content={
         "src": f"http://10.22.125.155:8080/api/fastapi/upload/{file.filename}",
@@ -68,18 +119,32 @@ async def get_image(path: str):
 # 处理分割请求
 @app.post("/segment")
 def process_image(body: dict):
-    global last_image, last_logit
+    global last_image_key, last_logit
     print("start processing image", time.time())
     path = body["path"]
     is_first_segment = False
-    # 看上次分割的图片是不是该图片
-    if path != last_image:  # 不是该图片，重新生成图像embedding
-        pil_image = Image.open(path)
-        np_image = np.array(pil_image)
-        predictor.set_image(np_image)
-        last_image = path
+    # 按内容判断上次分割的图片是不是该图片，同名文件被重新上传也视为新图片
+    key = embedding_cache_key(path)
+    if key != last_image_key:  # 不是该图片，重新生成图像embedding
+        cached = embedding_cache.get(key)
+        if cached is not None:
+            embedding_cache.move_to_end(key)
+            predictor.features, predictor.original_size, predictor.input_size = cached
+            predictor.is_image_set = True
+            print("命中embedding缓存")
+        else:
+            pil_image = Image.open(path)
+            np_image = np.asarray(pil_image)
+            with torch.inference_mode(), torch.autocast("cuda", dtype=AMP_DTYPE):
+                predictor.set_image(np_image)
+            # mask decoder保持fp32，输出的logits可以直接转成numpy
+            predictor.features = predictor.features.float()
+            embedding_cache[key] = (predictor.features, predictor.original_size, predictor.input_size)
+            if len(embedding_cache) > EMBEDDING_CACHE_SIZE:
+                embedding_cache.popitem(last=False)
+            print("第一次识别该图片，获取embedding中")
+        last_image_key = key
         is_first_segment = True
-        print("第一次识别该图片，获取embedding中")
     # 获取mask
     clicks = body["clicks"]
     input_points = []
@@ -90,12 +155,13 @@ def process_image(body: dict):
     print("input_points:{}, input_labels:{}".format(input_points, input_labels))
     input_points = np.array(input_points)
     input_labels = np.array(input_labels)
-    masks, scores, logits = predictor.predict(
-        point_coords=input_points,
-        point_labels=input_labels,
-        mask_input=last_logit[None, :, :] if not is_first_segment else None,
-        multimask_output=is_first_segment  # 第一次产生3个结果，选择最优的
-    )
+    with torch.inference_mode():
+        masks, scores, logits = predictor.predict(
+            point_coords=input_points,
+            point_labels=input_labels,
+            mask_input=last_logit[None, :, :] if not is_first_segment else None,
+            multimask_output=is_first_segment  # 第一次产生3个结果，选择最优的
+        )
     # 设置mask_input，为下一次做准备
     best = np.argmax(scores)
     last_logit = logits[best, :, :]
@@ -106,8 +172,8 @@ def process_image(body: dict):
     # print("Uint8Array([" + ", ".join(map(str, numpy_array)) + "])")
     source_mask = mask_utils.encode(np.asfortranarray(masks))["counts"].decode("utf-8")
     # print(source_mask)
-    lzs = lzstring.LZString()
-    encoded = lzs.compressToEncodedURIComponent(source_mask)
+    # zlib为C实现，前端使用浏览器自带的DecompressionStream解压
+    encoded = base64.b64encode(zlib.compress(source_mask.encode("ascii"), 1)).decode("ascii")
 
     print("process finished", time.time())
     return {"shape": masks.shape, "mask": encoded}
@@ -118,7 +184,7 @@ def segment_everything(path: str):
     start_time = time.time()
     print("start segment_everything", start_time)
     pil_image = Image.open(path)
-    np_image = np.array(pil_image)
+    np_image = np.asarray(pil_image)
     masks = mask_generator.generate(np_image)
     
     sorted_anns = sorted(masks, key=(lambda x: x['area']), reverse=True)
@@ -136,15 +202,21 @@ def segment_everything(path: str):
 @app.get("/automatic_masks")
 def automatic_masks(path: str):
     pil_image = Image.open(path)
-    np_image = np.array(pil_image)
+    np_image = np.asarray(pil_image)
     mask = mask_generator.generate(np_image)
     
     sorted_anns = sorted(mask, key=(lambda x: x['area']), reverse=True)
-    lzs = lzstring.LZString()
     res = []
-    for ann in sorted_anns:
-        m = ann['segmentation']
-        source_mask = mask_utils.encode(m)['counts'].decode("utf-8")
+    if not sorted_anns:
+        return res
+    # 一次性编码所有mask，pycocotools接受 (H, W, N) 的uint8 Fortran序数组
+    h, w = sorted_anns[0]['segmentation'].shape
+    masks_stack = np.empty((h, w, len(sorted_anns)), dtype=np.uint8, order="F")
+    for i, ann in enumerate(sorted_anns):
+        masks_stack[:, :, i] = ann['segmentation']
+    rles = mask_utils.encode(masks_stack)
+    for ann, rle in zip(sorted_anns, rles):
+        source_mask = rle['counts'].decode("utf-8")
         encoded = lzs.compressToEncodedURIComponent(source_mask)
         res.append({
             "encodedMask": encoded,
@@ -154,18 +226,12 @@ def automatic_masks(path: str):
 
 # 压缩图片辅助函数
 def my_compress(img):
-    result = []
-    last_pixel = img[0][0]
-    count = 0
-    for line in img:
-        for pixel in line:
-            if pixel == last_pixel:
-                count += 1
-            else:
-                result.append(count)
-                result.append(int(last_pixel))
-                last_pixel = pixel
-                count = 1
-    result.append(count)
-    result.append(int(last_pixel))
-    return result
\ No newline at end of file
+    # 游程编码，输出 [count, pixel, count, pixel, ...]
+    flat = img.ravel()
+    boundaries = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    starts = np.concatenate(([0], boundaries))
+    ends = np.concatenate((boundaries, [flat.size]))
+    result = np.empty(2 * starts.size, dtype=np.int64)
+    result[0::2] = ends - starts
+    result[1::2] = flat[starts]
+    return result.tolist()
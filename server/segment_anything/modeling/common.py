@@ -36,8 +36,12 @@ class LayerNorm2d(nn.Module):
         self.eps = eps
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        # Compute statistics in fp32: autocast leaves this elementwise code in
+        # half precision, where pow(2) overflows for deviations above ~256.
+        input_dtype = x.dtype
+        x = x.float()
         u = x.mean(1, keepdim=True)
         s = (x - u).pow(2).mean(1, keepdim=True)
         x = (x - u) / torch.sqrt(s + self.eps)
         x = self.weight[:, None, None] * x + self.bias[:, None, None]
-        return x
+        return x.to(input_dtype)